@@ -12,6 +12,7 @@ from nonebot.typing import T_State
 from nonebot.plugin import PluginMetadata
 from nonebot.permission import SUPERUSER
 from nonebot.exception import FinishedException
+from tortoise.transactions import in_transaction
 
 __plugin_meta__ = PluginMetadata(
     name="无线电日志(QSO)",
@@ -29,6 +30,7 @@ from nonebot_plugin_tortoise_orm import add_model
 from nonebot_plugin_apscheduler import scheduler
 from .config import plugin_config
 from .utils import parse_line
+from .grid import normalize_grid, find_grid, get_summary, record_grids, forget_grids, recalc_user
 from .render import logs_to_image
 
 # 数据库连接
@@ -97,6 +99,7 @@ mod_cmd = on_command("修改qso", priority=5, block=True)
 del_cmd = on_command("删除qso", priority=5, block=True)
 set_cmd = on_command("设置", aliases={"preset"}, priority=5, block=True)
 tz_cmd = on_command("修改时区", aliases={"set_timezone"}, priority=5, block=True)
+odx_cmd = on_command("最远通联", aliases={"odx", "ODX"}, priority=5, block=True)
 
 relay_query = on_command("查中继", aliases={"中继查询", "查询中继"}, priority=5, block=True)
 relay_add = on_command("添加中继", priority=5, block=True)
@@ -171,7 +174,10 @@ async def logic_delete(event: MessageEvent, msg_args: str):
     elif raw.isdigit(): ids = [int(raw)]
     if not ids: await get_bot().send(event, "请指定ID (例: 10 或 10-15)"); return
     
-    count = await QsoLog.filter(id__in=ids, owner=user).delete()
+    # 网格计数与日志同进同退
+    async with in_transaction(DB_NAME):
+        await forget_grids(user, ids)
+        count = await QsoLog.filter(id__in=ids, owner=user).delete()
     if count: await get_bot().send(event, f"🗑️ 删除 {count} 条记录")
     else: await get_bot().send(event, "未找到记录")
 
@@ -221,14 +227,19 @@ async def confirm_time(event: MessageEvent, state: T_State):
         is_bj = "2" in choice
         user = state["user"]
         now = datetime.utcnow()
-        for item in state["valid_data"]:
-            t = item.get('datetime_obj') or now
-            if item.get('datetime_obj') and is_bj: t -= timedelta(hours=8)
-            
-            await QsoLog.create(owner=user, callsign=item['callsign'], freq=item['freq'],
-                rst=item['rst'], qth=item['qth'], rig=item['rig'], antenna=item['antenna'],
-                power=item['power'], sat_name=item['sat_name'], time=t,
-                input_timezone="UTC+8" if is_bj else "UTC")
+        grid_pairs = []
+        async with in_transaction(DB_NAME):
+            for item in state["valid_data"]:
+                t = item.get('datetime_obj') or now
+                if item.get('datetime_obj') and is_bj: t -= timedelta(hours=8)
+                
+                log = await QsoLog.create(owner=user, callsign=item['callsign'], freq=item['freq'],
+                    rst=item['rst'], qth=item['qth'], rig=item['rig'], antenna=item['antenna'],
+                    power=item['power'], sat_name=item['sat_name'], time=t,
+                    input_timezone="UTC+8" if is_bj else "UTC")
+                if item.get('grid'): grid_pairs.append((log, item['grid']))
+            # 整批计算距离/方位，增量更新 ODX 与网格数
+            await record_grids(user, grid_pairs)
         msg = f"🎉 已保存 {len(state['valid_data'])} 条!"
         if state["error_msg"]: msg += f"\n⚠️ 未导入:\n{state['error_msg']}"
         await qso_cmd.finish(msg)
@@ -239,7 +250,7 @@ async def confirm_time(event: MessageEvent, state: T_State):
 @help_cmd.handle()
 async def help_handler(event: MessageEvent):
     if not await check_permission(event, respond=True): return
-    await get_bot().send(event, "📻 无线电日志 📻\n1️⃣ 注册: 注册呼号 <呼号>\n2️⃣ 设置: 设置 设备 <名> 功率 <值>\n3️⃣ 记录: QSO <呼号> [日期] [时间] <频率> <RST> [设备] [天馈] [功率] [QTH]\n4️⃣ 查询: 查中继 <地名>\n5️⃣ 管理: 查看 | 导出 | 修改 <ID> | 删除 <ID>")
+    await get_bot().send(event, "📻 无线电日志 📻\n1️⃣ 注册: 注册呼号 <呼号>\n2️⃣ 设置: 设置 设备 <名> 功率 <值>\n3️⃣ 记录: QSO <呼号> [日期] [时间] <频率> <RST> [设备] [天馈] [功率] [QTH] [网格]\n   (网格: 6位可写在任意位置，4位需写在功率之后的 QTH 里)\n4️⃣ 查询: 查中继 <地名> | 最远通联\n5️⃣ 管理: 查看 | 导出 | 修改 <ID> | 删除 <ID>")
 
 @reg_cmd.handle()
 async def _(event: MessageEvent, args: Message = CommandArg()):
@@ -259,15 +270,25 @@ async def _(event: MessageEvent, args: Message = CommandArg()):
     if not user: await set_cmd.finish("未注册")
     txt = args.extract_plain_text().strip()
     parts = txt.split()
-    if not parts: await set_cmd.finish(f"当前预设:\n设备: {user.my_rig}\n功率: {user.my_power}\n\n修改例: 设置 设备 K5 功率 5W")
+    if not parts: await set_cmd.finish(f"当前预设:\n设备: {user.my_rig}\n功率: {user.my_power}\n网格: {user.my_grid}\n\n修改例: 设置 设备 K5 功率 5W 网格 OM89")
     iter_parts = iter(parts)
     updated = []
+    old_grid = user.my_grid
     for k in iter_parts:
         val = next(iter_parts, None)
         if not val: break
         if k in ["设备", "rig"]: user.my_rig = val; updated.append("设备")
         elif k in ["功率", "power"]: user.my_power = val; updated.append("功率")
-    if updated: await user.save(); await set_cmd.finish(f"✅ 已更新: {', '.join(updated)}")
+        elif k in ["网格", "grid"]:
+            g = normalize_grid(val, min_len=4)
+            if not g: await set_cmd.finish(f"❌ 网格格式错误: {val} (例: OM89 / OM89EU)")
+            user.my_grid = g; updated.append("网格")
+    if updated:
+        async with in_transaction(DB_NAME):
+            await user.save()
+            # 本台位置变了，历史距离/方位整体重算
+            if user.my_grid != old_grid: await recalc_user(user)
+        await set_cmd.finish(f"✅ 已更新: {', '.join(updated)}")
 
 @mod_cmd.handle()
 async def _(event: MessageEvent, state: T_State, args: Message = CommandArg()):
@@ -280,20 +301,44 @@ async def _(event: MessageEvent, state: T_State, args: Message = CommandArg()):
     log = await QsoLog.filter(id=int(msg), owner=user).first()
     if not log: await mod_cmd.finish("找不到记录")
     state["log"] = log
-    await mod_cmd.send(f"修改 #{log.id}\n当前: {log.callsign} {log.freq}\n发送修改内容(换行分隔):\n频率 438.500")
+    state["user"] = user
+    await mod_cmd.send(f"修改 #{log.id}\n当前: {log.callsign} {log.freq}\n发送修改内容(换行分隔):\n频率 438.500\n网格 OM89EU (清除: 网格 -)")
 
 @mod_cmd.got("content")
 async def _(event: MessageEvent, state: T_State):
     lines = event.get_message().extract_plain_text().strip().split('\n')
     changes = {}
-    map_keys = {"呼号":"callsign", "频率":"freq", "信号":"rst", "QTH":"qth", "设备":"rig", "天馈":"antenna", "功率":"power"}
+    map_keys = {"呼号":"callsign", "频率":"freq", "信号":"rst", "QTH":"qth", "设备":"rig", "天馈":"antenna", "功率":"power", "网格":"grid"}
     for l in lines:
         p = l.split(maxsplit=1)
         if len(p)==2 and p[0].upper() in map_keys: changes[map_keys[p[0].upper()]] = p[1]
     if not changes: await mod_cmd.finish("❌ 无效修改")
+    from .model import QsoGrid
     log = state["log"]
-    for k,v in changes.items(): setattr(log, k, v)
-    await log.save()
+    grid = changes.pop("grid", None)
+    if grid is not None: grid = grid.strip()
+    if grid is not None and grid != "-":
+        grid = normalize_grid(grid, min_len=4)
+        if not grid: await mod_cmd.finish("❌ 网格格式错误 (例: OM89 / OM89EU，清除用 网格 -)")
+    async with in_transaction(DB_NAME):
+        user = state["user"]
+        await get_summary(user)  # 先完成历史补录，old 才准确
+        old = await QsoGrid.get_or_none(log_id=log.id)
+        # 只改 QTH 时，和记录时一样从 QTH 里取网格；原网格随 QTH 一起被删掉则清除
+        if grid is None and "qth" in changes:
+            g, _ = find_grid(changes["qth"].split(), qth_from=0)
+            if g: grid = g
+            elif old and old.grid in log.qth.upper().split(): grid = "-"
+        if grid is not None:
+            # 网格 "-" 表示清除；QTH 为空或是之前自动填的网格则跟着改
+            new = grid if grid != "-" else None
+            if "qth" not in changes:
+                if old and log.qth == old.grid: log.qth = new or "-"
+                elif not old and log.qth == "-" and new: log.qth = new
+            await forget_grids(user, [log.id])
+            await record_grids(user, [(log, new)])
+        for k,v in changes.items(): setattr(log, k, v)
+        await log.save()
     await mod_cmd.finish("✅ 修改成功")
 
 @relay_query.handle()
@@ -329,6 +374,29 @@ async def _(event: MessageEvent):
                 count += 1
     await relay_import.finish(f"✅ 重载完成: {count}条")
 
+@odx_cmd.handle()
+async def _(event: MessageEvent):
+    from .model import QsoLog
+    if not await check_permission(event): return
+    user = await get_user(event)
+    if not user: await odx_cmd.finish("未注册")
+    # 直接读增量维护的记录，不扫历史 (仅首次查询从历史 QTH 补录一次)
+    async with in_transaction(DB_NAME):
+        s = await get_summary(user)
+    if (not s.grid_count and s.odx_km is None): await odx_cmd.finish("暂无网格记录 (QSO 末尾带上对方网格即可统计)")
+    msg = f"🌍 {user.callsign} 已通联网格: {s.grid_count} 个"
+    if s.odx_km is not None:
+        # 呼号/时间可能被修改过，按主键回查日志
+        log = await QsoLog.get_or_none(id=s.odx_log_id)
+        msg += (f"\n📏 最远通联: {log.callsign if log else '-'} [{s.odx_grid}]"
+                f"\n距离 {s.odx_km:.1f} km  方位 {s.odx_bearing:.0f}°")
+        if log:
+            t = log.time
+            if user.timezone == "UTC+8": t += timedelta(hours=8)
+            msg += f"\n时间 {t.strftime('%Y-%m-%d %H:%M')} ({user.timezone})"
+    elif not user.my_grid: msg += "\n⚠️ 未设置本台网格，无法计算距离 (设置 网格 OM89)"
+    await odx_cmd.finish(msg)
+
 @tz_cmd.handle()
 async def _(event: MessageEvent, args: Message = CommandArg()):
     if not await check_permission(event): return
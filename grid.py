@@ -0,0 +1,181 @@
+import re
+import numpy as np
+
+# Maidenhead 网格：2/4/6/8 位 (例: OM, OM89, OM89EU, OM89EU12)
+RE_GRID = re.compile(r'^[A-R]{2}(?:[0-9]{2}(?:[A-X]{2}(?:[0-9]{2})?)?)?$')
+EARTH_RADIUS_KM = 6371.0088
+
+# 各精度格子的 (经度宽, 纬度高)，单位：度
+_STEPS = [(20.0, 10.0), (2.0, 1.0), (5 / 60, 2.5 / 60), (0.5 / 60, 0.25 / 60)]
+
+def normalize_grid(token: str, min_len: int = 2):
+    """规范化网格 (大写)，不是合法网格或短于 min_len 位返回 None"""
+    if not token: return None
+    g = token.strip().upper()
+    return g if RE_GRID.match(g) and len(g) >= min_len else None
+
+def find_grid(tokens: list, qth_from: int = 3):
+    """
+    在尾部参数中找网格，返回 (网格, 下标)，没找到返回 (None, -1)
+    6/8 位网格任意位置都认；4 位容易和设备型号撞 (ID52/IC92)，只在 QTH 位置(第 qth_from 个起)认
+    单独解析 QTH 文本时传 qth_from=0
+    """
+    for i, t in enumerate(tokens):
+        g = normalize_grid(t, min_len=6)
+        if g: return g, i
+    for i, t in enumerate(tokens[qth_from:], qth_from):
+        g = normalize_grid(t, min_len=4)
+        if g and len(g) == 4: return g, i
+    return None, -1
+
+def grid_to_latlon(grid: str):
+    """网格 -> 格子中心点 (纬度, 经度)"""
+    g = normalize_grid(grid)
+    if not g: raise ValueError(f"无效网格: {grid}")
+    lon, lat = -180.0, -90.0
+    for n in range(len(g) // 2):
+        a, b = g[n * 2], g[n * 2 + 1]
+        base = "0" if a.isdigit() else "A"
+        w, h = _STEPS[n]
+        lon += (ord(a) - ord(base)) * w
+        lat += (ord(b) - ord(base)) * h
+    w, h = _STEPS[len(g) // 2 - 1]
+    return lat + h / 2, lon + w / 2
+
+def grids_to_latlon(grids: list):
+    """批量解码，返回 (纬度数组, 经度数组)"""
+    pts = np.array([grid_to_latlon(g) for g in grids], dtype=float).reshape(-1, 2)
+    return pts[:, 0], pts[:, 1]
+
+def distance_bearing(lat1, lon1, lat2, lon2):
+    """
+    大圆距离 (km) 与初始方位角 (度, 正北为0顺时针)，参数可为标量或数组
+    """
+    p1, l1, p2, l2 = (np.radians(np.asarray(x, dtype=float)) for x in (lat1, lon1, lat2, lon2))
+    dp, dl = p2 - p1, l2 - l1
+    a = np.sin(dp / 2) ** 2 + np.cos(p1) * np.cos(p2) * np.sin(dl / 2) ** 2
+    dist = 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(np.clip(a, 0.0, 1.0)))
+    y = np.sin(dl) * np.cos(p2)
+    x = np.cos(p1) * np.sin(p2) - np.sin(p1) * np.cos(p2) * np.cos(dl)
+    brg = (np.degrees(np.arctan2(y, x)) + 360.0) % 360.0
+    return dist, brg
+
+def batch_distance_bearing(origin: str, lats, lons):
+    """以 origin 为本台，批量计算到各点的距离/方位；本台网格无效返回 (None, None)"""
+    if not normalize_grid(origin, min_len=4): return None, None
+    lat0, lon0 = grid_to_latlon(origin)
+    return distance_bearing(lat0, lon0, lats, lons)
+
+# ================= 记录维护 (增量) =================
+# 以下函数不自带事务，调用方需连同日志的增删改一起包在 in_transaction() 里
+
+ODX_FIELDS = ["odx_km", "odx_bearing", "odx_grid", "odx_log_id"]
+
+async def get_summary(user, exclude_ids=()):
+    """
+    取用户的网格记录；首次创建时从历史日志的 QTH 补录网格 (一次性)
+    exclude_ids: 正在保存、稍后由调用方自行登记的日志
+    """
+    from .model import HamGridSummary
+    summary, created = await HamGridSummary.get_or_create(owner=user)
+    if created:
+        await _backfill(user, exclude_ids)
+        await summary.refresh_from_db()
+    return summary
+
+async def _backfill(user, exclude_ids=()):
+    from .model import QsoLog, QsoGrid
+    skip = set(exclude_ids) | set(await QsoGrid.filter(owner=user).values_list("log_id", flat=True))
+    pairs = []
+    for log in await QsoLog.filter(owner=user).all():
+        if log.id in skip or not log.qth: continue
+        g, _ = find_grid(log.qth.split(), qth_from=0)
+        if g: pairs.append((log, g))
+    await _record(user, pairs)
+
+async def _refresh_odx(user, summary):
+    """ODX 失效时 (删除/改网格/改本台网格) 走 (owner, distance_km) 索引取最远一条"""
+    from .model import QsoGrid
+    top = await QsoGrid.filter(owner=user, distance_km__isnull=False).order_by('-distance_km').first()
+    if top:
+        summary.odx_km, summary.odx_bearing = top.distance_km, top.bearing
+        summary.odx_grid, summary.odx_log_id = top.grid, top.log_id
+    else:
+        summary.odx_km = summary.odx_bearing = summary.odx_grid = summary.odx_log_id = None
+
+async def record_grids(user, pairs: list):
+    """
+    保存一批 QSO 的网格信息，并增量更新 ODX / 网格计数
+    pairs: [(QsoLog, 网格), ...]
+    """
+    pairs = [(log, g) for log, g in pairs if g]
+    if not pairs: return
+    await get_summary(user, exclude_ids=[log.id for log, _ in pairs])
+    await _record(user, pairs)
+
+async def _record(user, pairs: list):
+    from tortoise.expressions import F
+    from .model import QsoGrid, HamGridStat, HamGridSummary
+    if not pairs: return
+    grids = [g for _, g in pairs]
+    lats, lons = grids_to_latlon(grids)
+    dists, brgs = batch_distance_bearing(user.my_grid, lats, lons)
+
+    await QsoGrid.bulk_create([
+        QsoGrid(log=log, owner=user, grid=g, lat=float(lats[i]), lon=float(lons[i]),
+            distance_km=float(dists[i]) if dists is not None else None,
+            bearing=float(brgs[i]) if brgs is not None else None)
+        for i, (log, g) in enumerate(pairs)
+    ])
+
+    # 网格计数按 4 位统计
+    counts = {}
+    for g in grids: counts[g[:4]] = counts.get(g[:4], 0) + 1
+    new_grids = 0
+    for g4, n in counts.items():
+        stat, created = await HamGridStat.get_or_create(owner=user, grid=g4, defaults={"qso_count": n})
+        if created: new_grids += 1
+        else: await HamGridStat.filter(id=stat.id).update(qso_count=F("qso_count") + n)
+
+    summary = await get_summary(user)
+    if new_grids: await HamGridSummary.filter(id=summary.id).update(grid_count=F("grid_count") + new_grids)
+    if dists is not None:
+        k = int(np.argmax(dists))
+        if summary.odx_km is None or dists[k] > summary.odx_km:
+            summary.odx_km, summary.odx_bearing = float(dists[k]), float(brgs[k])
+            summary.odx_grid, summary.odx_log_id = grids[k], pairs[k][0].id
+            await summary.save(update_fields=ODX_FIELDS)
+
+async def forget_grids(user, log_ids: list):
+    """QSO 被删除/改网格前调用：撤销对应的网格计数，必要时刷新 ODX"""
+    from tortoise.expressions import F
+    from .model import QsoGrid, HamGridStat, HamGridSummary
+    summary = await get_summary(user)
+    rows = await QsoGrid.filter(owner=user, log_id__in=log_ids).all()
+    if not rows: return
+
+    counts = {}
+    for r in rows: counts[r.grid[:4]] = counts.get(r.grid[:4], 0) + 1
+    for g4, n in counts.items():
+        await HamGridStat.filter(owner=user, grid=g4).update(qso_count=F("qso_count") - n)
+    gone = await HamGridStat.filter(owner=user, qso_count__lte=0).delete()
+    await QsoGrid.filter(id__in=[r.id for r in rows]).delete()
+
+    if gone: await HamGridSummary.filter(id=summary.id).update(grid_count=F("grid_count") - gone)
+    if summary.odx_log_id in [r.log_id for r in rows]:
+        await _refresh_odx(user, summary)
+        await summary.save(update_fields=ODX_FIELDS)
+
+async def recalc_user(user):
+    """本台网格变更后，批量重算该用户全部距离/方位并刷新 ODX"""
+    from .model import QsoGrid
+    summary = await get_summary(user)
+    rows = await QsoGrid.filter(owner=user).all()
+    if rows:
+        dists, brgs = batch_distance_bearing(user.my_grid, [r.lat for r in rows], [r.lon for r in rows])
+        for i, r in enumerate(rows):
+            r.distance_km = float(dists[i]) if dists is not None else None
+            r.bearing = float(brgs[i]) if brgs is not None else None
+        await QsoGrid.bulk_update(rows, fields=["distance_km", "bearing"])
+    await _refresh_odx(user, summary)
+    await summary.save(update_fields=ODX_FIELDS)
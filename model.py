@@ -63,4 +63,52 @@ class QsoLog(Model):
 
     class Meta:
         table = "qso_logs"
-        app = "ham"
\ No newline at end of file
+        app = "ham"
+
+# QSO 网格信息 (由尾部参数识别的 Maidenhead 网格)
+class QsoGrid(Model):
+    id = fields.IntField(pk=True)
+    log = fields.OneToOneField('ham.QsoLog', related_name='grid_info')
+    owner = fields.ForeignKeyField('ham.HamUser', related_name='grid_logs')
+
+    grid = fields.CharField(max_length=8)
+    lat = fields.FloatField()
+    lon = fields.FloatField()
+
+    # 本台未设置网格时为空
+    distance_km = fields.FloatField(null=True)
+    bearing = fields.FloatField(null=True)
+
+    class Meta:
+        table = "qso_grids"
+        app = "ham"
+        # 取 ODX 用，按用户内距离排序
+        indexes = (("owner", "distance_km"),)
+
+# 每用户已通联网格 (4位) 计数
+class HamGridStat(Model):
+    id = fields.IntField(pk=True)
+    owner = fields.ForeignKeyField('ham.HamUser', related_name='grid_stats')
+    grid = fields.CharField(max_length=4)
+    qso_count = fields.IntField(default=0)
+
+    class Meta:
+        table = "ham_grid_stats"
+        app = "ham"
+        unique_together = (("owner", "grid"),)
+
+# 每用户 ODX / 网格数记录，随日志增量维护
+class HamGridSummary(Model):
+    id = fields.IntField(pk=True)
+    owner = fields.OneToOneField('ham.HamUser', related_name='grid_summary')
+    grid_count = fields.IntField(default=0)
+
+    odx_km = fields.FloatField(null=True)
+    odx_bearing = fields.FloatField(null=True)
+    odx_grid = fields.CharField(max_length=8, null=True)
+    # 呼号/时间以日志为准，按 id 回查
+    odx_log_id = fields.IntField(null=True)
+
+    class Meta:
+        table = "ham_grid_summary"
+        app = "ham"
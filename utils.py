@@ -1,6 +1,7 @@
 import re
 from datetime import datetime
 from .sat_data import SAT_DB
+from .grid import find_grid
 
 def parse_line(line: str, user_config: dict = None):
     """
@@ -143,7 +144,11 @@ def parse_line(line: str, user_config: dict = None):
         power = user_config.get("my_power") or "-"
         # QTH通常指对方的，不用己方预设
 
-    extra = data["extra"]
+    # Maidenhead 网格单独提取；写在设备/天馈/功率位置的不占位，写在 QTH 里的保留原文
+    extra = list(data["extra"])
+    grid, grid_idx = find_grid(extra)
+    if grid and grid_idx < 3: extra.pop(grid_idx)
+
     if len(extra) >= 1: rig = extra[0]
     if len(extra) >= 2: ant = extra[1]
     if len(extra) >= 3: 
@@ -154,6 +159,7 @@ def parse_line(line: str, user_config: dict = None):
         except:
             power = raw_p
     if len(extra) >= 4: qth = " ".join(extra[3:])
+    if grid and qth == "-": qth = grid
 
     return True, {
         "callsign": data["callsign"],
@@ -164,5 +170,6 @@ def parse_line(line: str, user_config: dict = None):
         "rig": rig,
         "antenna": ant,
         "power": power,
-        "qth": qth
+        "qth": qth,
+        "grid": grid
     }
\ No newline at end of file